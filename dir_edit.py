@@ -9,9 +9,9 @@
 
 """Rename or remove files in a directory using an editor."""
 
-from __future__ import print_function
 import sys
 import os
+import stat
 import re
 import tempfile
 import locale
@@ -19,32 +19,24 @@ import subprocess
 import argparse
 import shutil
 import shlex
-import pipes
 import random
-import itertools
 import logging
+import functools
 
-if sys.version_info < (3, 2):
-    os.fsencode = lambda filename: filename
-if sys.version_info < (3, 3):
-    shlex.quote = pipes.quote
+__version__ = '3.0.0'
 
 
 class Error(Exception):
     """Abort program, used in test suite."""
 
 
-def pairwise(iterable):
-    """s -> (s0, s1), (s1, s2), (s2, s3), ..."""
-    it1, it2 = itertools.tee(iterable)
-    next(it2, None)
-    return zip(it1, it2)
+def reversed_pairs(path):
+    """[s0, s1, s2, s3] -> (s3, s2), (s2, s1), (s1, s0)"""
+    return zip(path[:0:-1], path[-2::-1])
 
 
 def warning(msg, *args, **kwargs):
     """Output a warning message to stderr."""
-    if sys.version_info < (3, 0):
-        msg = msg.decode(errors='replace')
     logging.warning(msg, *args, **kwargs)
 
 
@@ -58,22 +50,9 @@ def rmdir_ops(path):
     return [((os.rmdir, 'rmdir'), (path,))]
 
 
-MAKEDIRS = os.makedirs
-if sys.version_info < (3, 4):
-    def makedirs_compat(name, exist_ok=False, **kwargs):
-        """Compatibility function with Python 3.4 os.makedirs()."""
-        try:
-            os.makedirs(name, **kwargs)
-        except OSError:
-            # This is broken in Python 3.2 and 3.3, cf. https://bugs.python.org/issue13498
-            if not exist_ok or not os.path.isdir(name):
-                raise
-    MAKEDIRS = makedirs_compat
-
-
 def makedirs_exist_ok(path):
     """Like os.makedirs(), but ignores existing directories."""
-    MAKEDIRS(path, exist_ok=True)
+    os.makedirs(path, exist_ok=True)
 
 
 def makedirs_ops(path):
@@ -98,7 +77,14 @@ def rmtree_ops(path):
 
 def path_remove_ops(path, recursive=False):
     """Return operations for removing path, optionally recursive."""
-    if os.path.islink(path) or not os.path.isdir(path):
+    # Symlinks to directories are removed like files:
+    try:
+        is_dir = stat.S_ISDIR(os.lstat(path).st_mode)
+    except OSError:
+        # Path vanished while editing (not checked for directory listings), the removal
+        # reports the error:
+        is_dir = False
+    if not is_dir:
         ops = remove_ops(path)
     elif os.listdir(path):
         if recursive:
@@ -125,30 +111,24 @@ def rename_ops(src, dst):
     return [((rename, 'mv -n'), (src, dst))]
 
 
-NUMKEY_REGEX = re.compile(r'(\s*[+-]?[0-9]+\.?[0-9]*\s*)(.*)')
-
-
-def numkey(string):
-    """Return a sort key that works for filenames like '23 - foo'."""
-    match = NUMKEY_REGEX.match(string)
-    if match:
-        return float(match.group(1)), locale.strxfrm(match.group(2))
-    return (0.0, locale.strxfrm(string))
-
+def collation_function():
+    """Return function transforming strings to sort keys for the current locale."""
+    if locale.setlocale(locale.LC_COLLATE) in ('C', 'POSIX'):
+        # locale.strxfrm() would just return a copy of the string:
+        return str
+    return locale.strxfrm
 
-def path_split_all(path):
-    """Return a list of path elements, e.g. 'a/b/..//c' -> ['a', 'c']."""
-    return os.path.normpath(path).split(os.sep)
 
+NUMKEY_MATCH = re.compile(r'(\s*[+-]?[0-9]+\.?[0-9]*\s*)(.*)').match
 
-def textkey_path(path):
-    """Return a sort key for paths, respecting user locale setting."""
-    return tuple(locale.strxfrm(s) for s in path_split_all(path))
 
-
-def numkey_path(path):
-    """Return a sort key that works for paths like '2/23 - foo'."""
-    return tuple(numkey(s) for s in path_split_all(path))
+def numkey(string, strxfrm=locale.strxfrm):
+    """Return a sort key that works for filenames like '23 - foo'."""
+    match = NUMKEY_MATCH(string)
+    if match:
+        number, rest = match.groups()
+        return float(number), strxfrm(rest)
+    return (0.0, strxfrm(string))
 
 
 def check_file_list(file_list):
@@ -162,10 +142,14 @@ def check_file_list(file_list):
 
 def read_file_list(filename):
     """Read a file containing a single path per line, return list of paths.
-    Can throw exception IOError.
+    Can throw exception OSError.
     """
     with open(filename, 'r') as stream:
-        return [line.rstrip('\r\n') for line in stream]
+        # Universal newlines mode translates '\r\n' and '\r' already:
+        lines = stream.read().split('\n')
+    if not lines[-1]:
+        lines.pop()
+    return lines
 
 
 def remove_hidden(names, all_entries=False):
@@ -183,28 +167,49 @@ def read_dir_flat(path, all_entries=False):
     return names
 
 
-def read_dir_recursive(path, all_entries=False):
+def read_dir_recursive(path, key, all_entries=False):
     """Return a list of paths in directory at path (recursively). If
     all_entries is not true, exclude all entries starting with a dot (.).
+    The entries of every directory are sorted by key, so the paths come out
+    in the order of comparing them element by element, without a final sort.
     """
     paths = []
-    for root, dirs, files in os.walk(path):
-        not_dirs = files + [name for name in dirs if os.path.islink(os.path.join(root, name))]
-        remove_hidden(not_dirs, all_entries)
-        for name in not_dirs:
-            paths.append(os.path.normpath(os.path.join(root, name)))
-        if root != path and not dirs and not files:
-            paths.append(os.path.normpath(root))
-        remove_hidden(dirs, all_entries)
+    top = os.path.normpath(path)
+    # Stack of (path, is_dir), sorted in reverse to pop the smallest first:
+    stack = [(top, True)]
+    while stack:
+        root, is_dir = stack.pop()
+        if not is_dir:
+            paths.append(root)
+            continue
+        prefix = '' if root == os.curdir else root + os.sep
+        try:
+            with os.scandir(root) as iterator:
+                entries = list(iterator)
+        except OSError:
+            # Like os.walk(), silently skip directories that cannot be listed.
+            continue
+        if root != top and not entries:
+            paths.append(root)
+        if not all_entries:
+            entries = [entry for entry in entries if not entry.name.startswith('.')]
+        # Names with equal keys (e.g. '1' and '01' with -n) are ordered by name:
+        entries.sort(key=lambda entry: (key(entry.name), entry.name), reverse=True)
+        # Symlinks to directories are not followed:
+        stack.extend((prefix + entry.name, entry.is_dir(follow_symlinks=False))
+                     for entry in entries)
     return paths
 
 
-def read_dir(path, args):
-    """Return a list of paths in directory at path, possibly recursively."""
+def read_dir(path, args, key):
+    """Return a list of paths in directory at path, possibly recursively,
+    sorted by applying key to the path elements.
+    """
     if args.recursive:
-        paths = read_dir_recursive(path, args.all)
+        paths = read_dir_recursive(path, key, args.all)
     else:
         paths = read_dir_flat(path, args.all)
+        paths.sort(key=lambda path: (key(path), path))
     return paths
 
 
@@ -221,7 +226,7 @@ def decompose_mapping(mapping):
     mapping = mapping.copy()
     paths = {}
     cycles = {}
-    srcs = set(mapping.keys()) - set(mapping.values())  # set() for Python 2
+    srcs = mapping.keys() - mapping.values()
     while mapping:
         try:
             src = srcs.pop()
@@ -229,9 +234,11 @@ def decompose_mapping(mapping):
         except KeyError:
             src, dst = mapping.popitem()
         path = [src, dst]
-        while dst in mapping:
-            dst = mapping.pop(dst)
+        # Paths are never None:
+        dst = mapping.pop(dst, None)
+        while dst is not None:
             path.append(dst)
+            dst = mapping.pop(dst, None)
         # Use normcase to allow case-renaming on Windows:
         if normcase(src) == normcase(path[-1]):
             cycles[src] = path
@@ -240,10 +247,12 @@ def decompose_mapping(mapping):
     return paths.values(), cycles.values()
 
 
-def make_relpath(path):
-    """Return relative path to current directory, raise error if it leads outside."""
+def make_relpath(path, cwd):
+    """Return relative path to current directory cwd (absolute), raise error if it
+    leads outside. Passing cwd saves os.path.relpath() two getcwd() calls per path.
+    """
     try:
-        relpath = os.path.relpath(path)
+        relpath = os.path.relpath(os.path.join(cwd, path), cwd)
         if relpath.startswith(os.pardir + os.sep):
             raise Error('error, path {} leads outside given directory'.format(path))
         return relpath
@@ -251,25 +260,34 @@ def make_relpath(path):
         raise Error('{}: {}'.format(path, exc)) from exc
 
 
+def find_entry(file_list, relpath, cwd):
+    """Return first non-empty entry of file_list leading to relpath, for error messages."""
+    return next(entry for entry in file_list if entry and make_relpath(entry, cwd) == relpath)
+
+
 def generate_mapping(input_file_list, output_file_list):
     """Generate renames and removals from file lists."""
     renames = {}
     removals = []
-    src_seen = {}
-    dst_seen = {}
+    # The conflicting entries are looked up again for error messages:
+    src_seen = set()
+    dst_seen = set()
+    cwd = os.getcwd()
     for srcfile, dstfile in zip(input_file_list, output_file_list):
-        src = make_relpath(srcfile)
+        src = make_relpath(srcfile, cwd)
         if src in src_seen:
-            raise Error('error, duplicate input entries {} and {}'.format(srcfile, src_seen[src]))
-        src_seen[src] = srcfile
+            raise Error('error, duplicate input entries {} and {}'.format(
+                srcfile, find_entry(input_file_list, src, cwd)))
+        src_seen.add(src)
         # empty lines indicate removal
         if not dstfile:
             removals.append(src)
             continue
-        dst = make_relpath(dstfile)
+        dst = src if dstfile == srcfile else make_relpath(dstfile, cwd)
         if dst in dst_seen:
-            raise Error('error, duplicate target entries {} and {}'.format(dstfile, dst_seen[dst]))
-        dst_seen[dst] = dstfile
+            raise Error('error, duplicate target entries {} and {}'.format(
+                dstfile, find_entry(output_file_list, dst, cwd)))
+        dst_seen.add(dst)
         # no self loops (need no renaming!)
         if src != dst:
             renames[src] = dst
@@ -278,12 +296,12 @@ def generate_mapping(input_file_list, output_file_list):
 
 def get_file_list_from_user(file_list, args):
     """Return user-edited file_list or raise error."""
-    tmpdir = tempfile.mkdtemp(prefix='dir_edit-')
-    tmpfile = os.path.join(tmpdir, 'file_list.txt')
     nl_re = re.compile(r'[\n\r]+')
-    nl_buf = os.linesep.encode()
-    with open(tmpfile, 'wb') as stream:
-        stream.write(b''.join([os.fsencode(nl_re.sub(' ', e)) + nl_buf for e in file_list]))
+    # File names cannot contain NUL, so it separates them for a single substitution:
+    text = nl_re.sub(' ', '\0'.join(file_list)).replace('\0', os.linesep) + os.linesep
+    tmpfd, tmpfile = tempfile.mkstemp(prefix='dir_edit-', suffix='.txt')
+    with os.fdopen(tmpfd, 'wb') as stream:
+        stream.write(os.fsencode(text))
     if os.name == 'nt':
         # Windows opens default editor if text file is opened directly:
         command = [tmpfile]
@@ -293,13 +311,11 @@ def get_file_list_from_user(file_list, args):
         command = args.editor + ' ' + shlex.quote(tmpfile)
     try:
         subprocess.check_call(command, shell=True)
-        with open(tmpfile, 'r') as stream:
-            return [line.rstrip('\r\n') for line in stream]
+        return read_file_list(tmpfile)
     except subprocess.CalledProcessError as exc:
         raise Error('editor command failed: {}'.format(command)) from exc
     finally:
         os.remove(tmpfile)
-        os.rmdir(tmpdir)
 
 
 def get_output_file_list(input_file_list, args):
@@ -307,7 +323,7 @@ def get_output_file_list(input_file_list, args):
     if args.output:
         try:
             return read_file_list(args.output)
-        except IOError as exc:
+        except OSError as exc:
             raise Error('error reading output file: {}'.format(exc.strerror)) from exc
     else:
         return get_file_list_from_user(input_file_list, args)
@@ -318,7 +334,7 @@ def get_input_file_list(args, orig_cwd):
     if args.input:
         try:
             file_list = read_file_list(args.input)
-        except IOError as exc:
+        except OSError as exc:
             raise Error('error reading input file: {}'.format(exc.strerror)) from exc
         check_file_list(file_list)
     elif args.files:
@@ -327,9 +343,12 @@ def get_input_file_list(args, orig_cwd):
             file_list.append(path if os.path.isabs(path) else os.path.join(orig_cwd, path))
         check_file_list(file_list)
     else:
-        file_list = read_dir(os.curdir, args)
-        key = textkey_path if not args.numeric_sort else numkey_path
-        file_list.sort(key=key)
+        strxfrm = collation_function()
+        key = strxfrm
+        if args.numeric_sort:
+            # Cached per listing, keys depend on the current collation:
+            key = functools.lru_cache(maxsize=None)(functools.partial(numkey, strxfrm=strxfrm))
+        file_list = read_dir(os.curdir, args, key)
     if not file_list:
         raise Error('no valid path given for renaming')
     if not args.mangle_newlines:
@@ -382,16 +401,16 @@ def generate_operations(paths, cycles, removals, args):
     dst_dirs = set()
     tmpdir = ''
     for path in paths:
-        for dst, src in pairwise(reversed(path)):
+        for dst, src in reversed_pairs(path):
             if not dst.startswith(src + os.sep):
-                src_dirs |= set(dirnames(src))
-                dst_dirs |= set(dirnames(dst))
+                src_dirs.update(dirnames(src))
+                dst_dirs.update(dirnames(dst))
     for filename in removals:
         ops += path_remove_ops(filename, args.remove_recursive)
     for filename in sorted(dst_dirs - src_dirs, key=len):
         ops += makedirs_ops(filename)
     for path in paths:
-        for dst, src in pairwise(reversed(path)):
+        for dst, src in reversed_pairs(path):
             if dst.startswith(src + os.sep):
                 tmpdir = create_tmpdir(ops, tmpdir)
                 tmp = os.path.join(tmpdir, os.path.basename(src))
@@ -407,7 +426,7 @@ def generate_operations(paths, cycles, removals, args):
         tmp = os.path.join(tmpdir, os.path.basename(cycle[0]))
         ops += rename_ops(cycle[0], tmp)
         cycle[0] = tmp
-        for dst, src in pairwise(reversed(cycle)):
+        for dst, src in reversed_pairs(cycle):
             ops += rename_ops(src, dst)
     ops += remove_tmpdir(tmpdir)
     return ops
@@ -419,8 +438,6 @@ def execute_operations(ops, args):
         if args.verbose:
             sep = ' -- ' if any(farg.startswith('-') for farg in fargs) else ' '
             msg = cmd + sep + ' '.join(shlex.quote(farg) for farg in fargs)
-            if sys.version_info < (3, 0):
-                msg = msg.decode(errors='replace')
             print(msg, file=args.logfile)
         if not args.dry_run and fun is not None:
             try:
@@ -444,11 +461,8 @@ def dir_edit(args):
     execute_operations(ops, args)
 
 
-def main_throws(args=None):
-    """Main function, throws exception on error."""
-    # For locale-specific sorting of filenames:
-    locale.setlocale(locale.LC_ALL, '')
-    #
+def build_parser():
+    """Return command line parser."""
     usage = '%(prog)s [OPTION]... [DIR] [FILES]...'
     desc = """\
 Modify contents of DIR using an editor. Creates a temporary file, where every
@@ -468,7 +482,7 @@ changes."""
                         help='directory to edit (default: current directory)')
     parser.add_argument('files', metavar='FILES', nargs='*',
                         help='limit to these filenames (default: all non-hidden in directory)')
-    parser.add_argument('--version', action='version', version='%(prog)s 3.0.0')
+    parser.add_argument('--version', action='version', version='%(prog)s ' + __version__)
     parser.add_argument('-a', '--all', action='store_true', default=False,
                         help='include entries starting with . (besides . and ..)')
     parser.add_argument('-d', '--dry-run', action='store_true',
@@ -493,9 +507,15 @@ changes."""
                         help='path to logfile for verbose mode (default: stdout)')
     parser.add_argument('-v', '--verbose', action='store_true', default=False,
                         help='output filesystem modifications to logfile')
-    args = parser.parse_args(args)
-    # Use style='{' after Python 2 support is dropped:
-    logging.basicConfig(format='%(module)s: %(message)s')
+    return parser
+
+
+def main_throws(args=None):
+    """Main function, throws exception on error."""
+    # For locale-specific sorting of filenames:
+    locale.setlocale(locale.LC_ALL, '')
+    args = build_parser().parse_args(args)
+    logging.basicConfig(format='{module}: {message}', style='{')
     dir_edit(args)
 
 
@@ -2,14 +2,12 @@
 
 """A setuptools based setup module."""
 
-from __future__ import unicode_literals
 import os
-import codecs
 from setuptools import setup
 
 # Get the long description from the README file
 HERE = os.path.abspath(os.path.dirname(__file__))
-with codecs.open(os.path.join(HERE, 'README.rst'), encoding='utf-8') as stream:
+with open(os.path.join(HERE, 'README.rst'), encoding='utf-8') as stream:
     LONG_DESCRIPTION = '\n'.join(stream.read().split('\n')[5:])
 
 setup(
@@ -8,164 +8,259 @@
 
 """Test module for dir_edit.py."""
 
-from __future__ import print_function
 import sys
 import os
 import re
 import errno
 import unittest
+from unittest import mock
 import tempfile
 import shutil
 from io import StringIO
 import subprocess
+import shlex
 import random
 import string
+import locale
 import logging
+import contextlib
+import functools
+import ast
+import itertools
 
 import dir_edit
 
+HERE = os.path.abspath(os.path.dirname(__file__))
+PROG = os.path.join(HERE, 'dir_edit.py')
+
+# Base for temporary directories: $DIR_EDIT_TEST_TMPDIR, else a RAM-backed file system if
+# available (the tests mostly rename, create and remove files), else the system default.
+TMPBASE = os.environ.get('DIR_EDIT_TEST_TMPDIR') or (
+    '/dev/shm' if os.access('/dev/shm', os.W_OK) else None)
+
+# Seed for the random tests, set $DIR_EDIT_TEST_SEED to reproduce a reported failure:
+RANDOM_SEED = int(os.environ.get('DIR_EDIT_TEST_SEED') or random.randrange(2**32))
+
+# Own root logger handler instead of logging.basicConfig(), whose handler is not the only
+# one under pytest; its stream is swapped to capture warnings:
+LOG_HANDLER = logging.StreamHandler()
+LOG_HANDLER.setFormatter(logging.Formatter('%(module)s: %(message)s'))
+logging.getLogger().addHandler(LOG_HANDLER)
+
+
+def walk_leaves(top):
+    """Yield (name, DirEntry) of leaf nodes of 'top' directory recursively. Names are
+    relative with '/' as separator, empty directories end with '/'.
+    """
+    stack = [(top, '', None)]
+    while stack:
+        root, prefix, root_entry = stack.pop()
+        empty = True
+        with os.scandir(root) as iterator:
+            for entry in iterator:
+                empty = False
+                name = prefix + entry.name
+                # Symlinks to directories are leaf nodes:
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append((entry.path, name + '/', entry))
+                else:
+                    yield name, entry
+        if empty and prefix:
+            yield prefix, root_entry
+
 
 def listdir_recursive(top):
     """Yield leaf nodes of 'top' directory recursively."""
-    for root, dirs, files in os.walk(top):
-        not_dirs = files + [name for name in dirs if os.path.islink(os.path.join(root, name))]
-        for name in not_dirs:
-            yield os.path.relpath(os.path.join(root, name), top).replace(os.sep, '/')
-        if root != top and not dirs and not files:
-            yield os.path.relpath(root, top).replace(os.sep, '/') + '/'
-
-
-def path_content(path):
-    """Return file content or '<dir>' for directories."""
-    if os.path.islink(path):
-        return '-> ' + os.readlink(path)
-    if os.path.isdir(path):
+    return (name for name, _ in walk_leaves(top))
+
+
+def entry_content(entry):
+    """Return file content or '<dir>' for directories of a DirEntry."""
+    if entry.is_symlink():
+        return '-> ' + os.readlink(entry.path)
+    if entry.is_dir(follow_symlinks=False):
         return '<dir>'
-    with open(path) as stream:
-        return stream.read()
+    fd = os.open(entry.path, os.O_RDONLY)
+    try:
+        return os.read(fd, 65536).decode(locale.getpreferredencoding(False))
+    finally:
+        os.close(fd)
 
 
+@functools.lru_cache(maxsize=None)
 def errno_regex(*codes):
-    """Return regular expression matching error messages for given errno codes."""
+    """Return regular expression matching error messages for given errno codes, cached."""
     if os.name == 'nt':
         # Do not deal with Windows error messages:
         return '(.*)'
     return '({})'.format('|'.join(re.escape(os.strerror(code)) for code in codes))
 
 
-def mkdir_p(path):
-    """Like os.makedirs(), but ignores existing directories."""
-    try:
-        os.makedirs(path)
-    except OSError:
-        if not os.path.isdir(path):
-            raise
-
-
-def fake_sys_exit(arg=0):
-    """Raise exception instead of exiting, for testing."""
-    raise Exception('sys.exit({!r})'.format(arg))
-
-
 def dir_edit_external(*args):
-    """Call dir_edit.py as external process."""
-    here = os.path.abspath(os.path.dirname(__file__))
-    prog = os.path.join(here, 'dir_edit.py')
+    """Call dir_edit.py as external process, with the current Python interpreter."""
+    command = [sys.executable, PROG]
     shell = False
     if os.name == 'nt':
+        command = [PROG]
         shell = True
-    return subprocess.check_output([prog] + list(args), stderr=subprocess.STDOUT, shell=shell,
+    return subprocess.check_output(command + list(args), stderr=subprocess.STDOUT, shell=shell,
                                    universal_newlines=True)
 
 
+PYSED = """\
+import sys
+_, old, new, path = sys.argv
+with open(path) as stream:
+    content = stream.read()
+with open(path, 'w') as stream:
+    stream.write(content.replace(old, new))
+"""
+
+
+def python_command(*args):
+    """Return shell command running the current Python interpreter with args."""
+    argv = [sys.executable] + list(args)
+    if os.name == 'nt':
+        return subprocess.list2cmdline(argv)
+    return ' '.join(shlex.quote(arg) for arg in argv)
+
+
+@functools.lru_cache(maxsize=None)
+def setup_version():
+    """Return version declared in setup.py, cached (parsed, not run by Python and
+    setuptools).
+    """
+    with open(os.path.join(HERE, 'setup.py'), encoding='utf-8') as stream:
+        tree = ast.parse(stream.read())
+    return next(ast.literal_eval(node.value) for node in ast.walk(tree)
+                if isinstance(node, ast.keyword) and node.arg == 'version')
+
+
 class DirEditTestCase(unittest.TestCase):
     # pylint: disable=too-many-instance-attributes,too-many-public-methods
-    # pylint: disable=deprecated-method
     """Main dir_edit.py test class."""
 
     @classmethod
     def setUpClass(cls):
-        """Add renamed member functions for Python 2.7."""
-        logging.basicConfig(format='%(module)s: %(message)s')
-        if sys.version_info < (3, 2):
-            cls.assertRegex = cls.assertRegexpMatches
-            cls.assertRaisesRegex = cls.assertRaisesRegexp
+        """Remember current directory, create root for temporary directories with directory
+        for input / output files shared by all tests.
+        """
+        cls.curdir = os.getcwd()
+        cls.tmproot = os.path.realpath(tempfile.mkdtemp(dir=TMPBASE))
+        cls.tmpdir2 = os.path.join(cls.tmproot, 'io')
+        os.mkdir(cls.tmpdir2)
+        cls.tmpfiles = {}
+        # Editor for '-e', replacing argv[1] with argv[2] in file argv[3]:
+        cls.pysed = os.path.join(cls.tmproot, 'pysed.py')
+        with open(cls.pysed, 'w') as stream:
+            stream.write(PYSED)
+        cls.tmpdir_counter = itertools.count()
+
+    @classmethod
+    def tearDownClass(cls):
+        """Remove root of temporary directories."""
+        shutil.rmtree(cls.tmproot)
 
     def setUp(self):
-        """Create temporary directories, declare attributes."""
-        self.curdir = os.getcwd()
-        self.tmpdir = os.path.realpath(tempfile.mkdtemp())
-        self.tmpdir2 = os.path.realpath(tempfile.mkdtemp())
-        self.original_stdout = []
-        self.original_stderr = []
-        self.stdout_buffer = []
-        self.stderr_buffer = []
+        """Create temporary directory (removed on cleanup, also after errors), declare
+        attributes.
+        """
+        self.tmpdir = os.path.join(self.tmproot, 'test{}'.format(next(self.tmpdir_counter)))
+        os.mkdir(self.tmpdir)
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        # Cleanups run in reverse order, leave the directory before removing it:
+        self.addCleanup(os.chdir, self.curdir)
         self.output = None
         self.error = None
 
-    def tearDown(self):
-        """Remove temporary directories."""
-        os.chdir(self.curdir)
-        shutil.rmtree(self.tmpdir2)
-        shutil.rmtree(self.tmpdir)
-
     def put_files(self, *filenames):
         """Put files into the temporary directory."""
-        for filename in filenames:
-            path = os.path.join(self.tmpdir, filename)
-            mkdir_p(os.path.dirname(path))
-            with open(path, 'w') as stream:
-                stream.write(filename)
+        prefix = self.tmpdir + os.sep
+        paths = [prefix + filename for filename in filenames]
+        for dirname in {os.path.dirname(path) for path in paths}:
+            os.makedirs(dirname, exist_ok=True)
+        encoding = locale.getpreferredencoding(False)
+        for filename, path in zip(filenames, paths):
+            fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o666)
+            try:
+                os.write(fd, filename.encode(encoding))
+            finally:
+                os.close(fd)
 
     def put_dirs(self, *dirnames):
         """Put directories into the temporary directory."""
-        for dirname in dirnames:
-            path = os.path.join(self.tmpdir, dirname)
-            mkdir_p(path)
+        prefix = self.tmpdir + os.sep
+        for dirname in set(dirnames):
+            os.makedirs(prefix + dirname, exist_ok=True)
 
     def tmpfile(self, *filenames):
-        """Create a temporary file with list of filenames, return path."""
-        with tempfile.NamedTemporaryFile(mode='w', dir=self.tmpdir2, delete=False) as tmpfile:
-            tmpfile.write('\n'.join(filenames) + '\n')
-        return tmpfile.name
+        """Create a temporary file with list of filenames, return path. The file is reused
+        for the same filenames in all tests of the class, so it must not be modified.
+        """
+        path = self.tmpfiles.get(filenames)
+        if path is not None:
+            return path
+        # tmpdir2 is private to the test class, the count makes names unique:
+        path = os.path.join(self.tmpdir2, 'tmp{}.txt'.format(len(self.tmpfiles)))
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+        try:
+            os.write(fd, ''.join(name + '\n' for name in filenames).encode(
+                locale.getpreferredencoding(False)))
+        finally:
+            os.close(fd)
+        self.tmpfiles[filenames] = path
+        return path
+
+    @contextlib.contextmanager
+    def seeded_random(self):
+        """Yield random generator seeded with RANDOM_SEED and the test name, report
+        DIR_EDIT_TEST_SEED for failures and errors inside. Independent of other tests and of
+        the test runner, so a test reproduces alone (e.g. with -k), but each test draws
+        different cases.
+        """
+        name = '{}.{}'.format(type(self).__name__, self._testMethodName)
+        with self.subTest(DIR_EDIT_TEST_SEED=RANDOM_SEED):
+            yield random.Random('{}-{}'.format(RANDOM_SEED, name))
 
     def list_tmpdir(self):
         """Return sorted list of leaf nodes of self.tmpdir recursively."""
         return sorted(listdir_recursive(self.tmpdir))
 
-    def path_content(self, path):
-        """Return file content or '<dir>' for directories of path relative to self.tmpdir."""
-        return path_content(os.path.join(self.tmpdir, path))
-
     def list_tmpdir_content(self):
         """Like list_tmpdir(), but return list of (path, content) tuples."""
-        return [(path, self.path_content(path)) for path in self.list_tmpdir()]
-
-    def setup_stdout(self):
-        """Replace stdout and stderr with StringIO() for later inspection."""
-        self.original_stdout.append(sys.stdout)
-        self.original_stderr.append(sys.stderr)
-        sys.stdout = StringIO()
-        sys.stderr = StringIO()
-        logging.getLogger().handlers[0].stream = sys.stderr
-        self.stdout_buffer.append(sys.stdout)
-        self.stderr_buffer.append(sys.stderr)
-
-    def restore_stdout(self):
-        """Restore stdout and stderr and store buffer values for inspection."""
-        self.output = self.stdout_buffer.pop().getvalue()
-        self.error = self.stderr_buffer.pop().getvalue()
-        sys.stdout = self.original_stdout.pop()
-        sys.stderr = self.original_stderr.pop()
-        logging.getLogger().handlers[0].stream = sys.stderr
-        sys.stdout.write(self.output)
-        sys.stderr.write(self.error)
+        return sorted((name, entry_content(entry)) for name, entry in walk_leaves(self.tmpdir))
+
+    @contextlib.contextmanager
+    def capture_output(self):
+        """Capture stdout and stderr (including warnings) in self.output and self.error,
+        pass them on afterwards.
+        """
+        stdout = StringIO()
+        stderr = StringIO()
+        LOG_HANDLER.stream = stderr
+        try:
+            with contextlib.redirect_stdout(stdout), contextlib.redirect_stderr(stderr):
+                yield
+        finally:
+            LOG_HANDLER.stream = sys.stderr
+            self.output = stdout.getvalue()
+            self.error = stderr.getvalue()
+            sys.stdout.write(self.output)
+            sys.stderr.write(self.error)
 
     def dir_edit(self, *args):
         """Convenience function to call dir_edit.py, restores current directory."""
-        curdir = os.getcwd()
-        self.call_dir_edit(list(args))
-        os.chdir(curdir)
+        try:
+            self.call_dir_edit(list(args))
+        finally:
+            # main_throws() always changes into DIR:
+            os.chdir(self.curdir)
+
+    def main_output(self, *args):
+        """Call dir_edit.py main function in-process, expect it to exit, return stdout."""
+        with self.capture_output(), self.assertRaises(SystemExit):
+            dir_edit.main(list(args))
+        return self.output
 
     def call_dir_edit(self, args):
         # Is a method to be overridden in child:
@@ -173,8 +268,8 @@ class DirEditTestCase(unittest.TestCase):
         """Call dir_edit.py main function."""
         dir_edit.main_throws(args)
 
-    def test_mkdir_p(self):
-        """Test internal function for coverage."""
+    def test_put_dirs_keeps_files(self):
+        """Check that put_files() and put_dirs() create parents, but do not replace files."""
         self.put_files('a/b')
         self.put_dirs('c/d')
         with self.assertRaisesRegex(OSError, errno_regex(errno.EEXIST)):
@@ -188,52 +283,43 @@ class DirEditTestCase(unittest.TestCase):
 
     def test_main(self):
         """Test main function for coverage."""
-        original_sys_exit = sys.exit
-        sys.exit = fake_sys_exit
-        with self.assertRaisesRegex(Exception, r'^sys.exit\(0\)$'):
+        with self.assertRaises(SystemExit) as context:
             dir_edit.main(['--help'])
-        sys.exit = original_sys_exit
+        self.assertEqual(0, context.exception.code)
 
     def test_main_error(self):
         """Test main function error for coverage."""
-        original_sys_exit = sys.exit
-        sys.exit = fake_sys_exit
-        with self.assertRaisesRegex(Exception, r'^sys.exit\(1\)$'):
+        with self.assertRaises(SystemExit) as context:
             dir_edit.main([os.path.join(self.tmpdir, 'nonexist')])
-        sys.exit = original_sys_exit
+        self.assertEqual(1, context.exception.code)
 
     def test_help(self):
         """Check that '-h' and '--help' options work."""
-        help_output1 = dir_edit_external('-h')
-        help_output2 = dir_edit_external('--help')
-        self.assertRegex(help_output1, '^usage: dir_edit')
+        help_output1 = self.main_output('-h')
+        help_output2 = self.main_output('--help')
+        self.assertRegex(help_output1, r'^usage: .* \[OPTION\]')
         self.assertEqual(help_output1, help_output2)
+        self.assertEqual(dir_edit.build_parser().format_help(), help_output1)
 
     def test_version(self):
         """Check that the '--version' option works."""
-        here = os.path.abspath(os.path.dirname(__file__))
-        setup_prog = os.path.join(here, 'setup.py')
-        version = subprocess.check_output(['python', setup_prog, '--version'],
-                                          universal_newlines=True)
         version_output = dir_edit_external('--version')
-        self.assertRegex(version_output, '^dir_edit.py ' + re.escape(version))
+        self.assertEqual('dir_edit.py {}\n'.format(dir_edit.__version__), version_output)
+
+    def test_setup_version(self):
+        """Check that setup.py declares the same version as dir_edit.py."""
+        self.assertEqual(dir_edit.__version__, setup_version())
 
     def test_editor(self):
         """Check that '-e' and '--editor' options work."""
         self.put_files('a1', 'a2')
-        pysed = (
-            'python -c "'
-            'from sys import argv as a;'
-            's = open(a[3]).read();'
-            "open(a[3], 'w').write(s.replace(a[1], a[2]))"
-            '"'
-        )
+        pysed = python_command(self.pysed)
         self.dir_edit(self.tmpdir, '-e', pysed + ' a b')
         self.assertEqual(['b1', 'b2'], self.list_tmpdir())
         self.dir_edit(self.tmpdir, '--editor', pysed + ' b c')
         self.assertEqual(['c1', 'c2'], self.list_tmpdir())
         with self.assertRaisesRegex(dir_edit.Error, 'editor command failed'):
-            self.dir_edit(self.tmpdir, '-e' 'python -c "exit(1)"')
+            self.dir_edit(self.tmpdir, '-e', python_command('-c', 'exit(1)'))
 
     def test_nonexisting(self):
         """Raise error if directory does not exist."""
@@ -256,6 +342,19 @@ class DirEditTestCase(unittest.TestCase):
         with self.assertRaisesRegex(dir_edit.Error, 'error reading output file'):
             self.dir_edit(self.tmpdir, '-o', os.path.join(self.tmpdir2, 'nonexist'))
 
+    def test_output_line_endings(self):
+        """Check that output files without final newline or with CRLF work."""
+        self.put_files('a1', 'a2')
+        output = os.path.join(self.tmpdir2, 'output')
+        with open(output, 'w') as stream:
+            stream.write('b1\nb2')
+        self.dir_edit(self.tmpdir, '-o', output)
+        self.assertEqual(['b1', 'b2'], self.list_tmpdir())
+        with open(output, 'wb') as stream:
+            stream.write(b'c1\r\n\r\n')
+        self.dir_edit(self.tmpdir, '-o', output)
+        self.assertEqual(['c1'], self.list_tmpdir())
+
     def test_input(self):
         """Check that '-i' and '--input' options work."""
         self.put_files('a1', 'a2')
@@ -288,10 +387,10 @@ class DirEditTestCase(unittest.TestCase):
         self.put_files('a\r\n1', 'a\n\n2')
         with self.assertRaisesRegex(dir_edit.Error, 'file names with newlines are not supported'):
             self.dir_edit(self.tmpdir)
-        self.dir_edit(self.tmpdir, '-m', '-e', 'python -c "exit(0)"')
+        self.dir_edit(self.tmpdir, '-m', '-e', python_command('-c', 'exit(0)'))
         self.assertEqual(['a 1', 'a 2'], self.list_tmpdir())
         self.put_files('a\r3')
-        self.dir_edit(self.tmpdir, '--mangle-newlines', '-e', 'python -c "exit(0)"')
+        self.dir_edit(self.tmpdir, '--mangle-newlines', '-e', python_command('-c', 'exit(0)'))
         self.assertEqual(['a 1', 'a 2', 'a 3'], self.list_tmpdir())
 
     def test_same_length(self):
@@ -308,6 +407,8 @@ class DirEditTestCase(unittest.TestCase):
             self.dir_edit(self.tmpdir, '-o', self.tmpfile('b', 'b'))
         with self.assertRaisesRegex(dir_edit.Error, 'duplicate target entries'):
             self.dir_edit(self.tmpdir, '-o', self.tmpfile('a1', 'a1'))
+        with self.assertRaisesRegex(dir_edit.Error, r'duplicate target entries c and \./c$'):
+            self.dir_edit(self.tmpdir, '-o', self.tmpfile('./c', 'c'))
         self.assertEqual(['a1', 'a2'], self.list_tmpdir())
 
     def test_relpath(self):
@@ -360,37 +461,43 @@ class DirEditTestCase(unittest.TestCase):
 
     def test_random(self):
         """Test random mapping, meant for repeated runs to find counter-example."""
-        universe = string.ascii_lowercase
-        src_files = random.sample(universe, random.randint(1, len(universe)))
-        dst_files = []
-        for _src in src_files:
-            unused = set(universe) - set(dst_files)
-            dst_files.append(random.choice(list(unused)))
-        result_content = sorted(zip(dst_files, src_files))
-        self.put_files(*src_files)
-        self.dir_edit(self.tmpdir, '-i', self.tmpfile(*src_files), '-o', self.tmpfile(*dst_files))
-        self.assertEqual(result_content, self.list_tmpdir_content())
+        with self.seeded_random() as rng:
+            universe = string.ascii_lowercase
+            src_files = rng.sample(universe, rng.randint(1, len(universe)))
+            dst_files = []
+            for _src in src_files:
+                unused = set(universe) - set(dst_files)
+                dst_files.append(rng.choice(list(unused)))
+            result_content = sorted(zip(dst_files, src_files))
+            self.put_files(*src_files)
+            self.dir_edit(self.tmpdir, '-i', self.tmpfile(*src_files),
+                          '-o', self.tmpfile(*dst_files))
+            self.assertEqual(result_content, self.list_tmpdir_content())
 
     def test_random_shuffle(self):
         """Test random shuffle mapping, meant for repeated runs to find counter-example."""
-        universe = string.ascii_lowercase
-        src_files = random.sample(universe, random.randint(1, len(universe)))
-        dst_files = random.sample(src_files, len(src_files))
-        result_content = sorted(zip(dst_files, src_files))
-        self.put_files(*src_files)
-        self.dir_edit(self.tmpdir, '-i', self.tmpfile(*src_files), '-o', self.tmpfile(*dst_files))
-        self.assertEqual(result_content, self.list_tmpdir_content())
+        with self.seeded_random() as rng:
+            universe = string.ascii_lowercase
+            src_files = rng.sample(universe, rng.randint(1, len(universe)))
+            dst_files = rng.sample(src_files, len(src_files))
+            result_content = sorted(zip(dst_files, src_files))
+            self.put_files(*src_files)
+            self.dir_edit(self.tmpdir, '-i', self.tmpfile(*src_files),
+                          '-o', self.tmpfile(*dst_files))
+            self.assertEqual(result_content, self.list_tmpdir_content())
 
     def test_random_path(self):
         """Test random path mapping, meant for repeated runs to find counter-example."""
-        universe = string.ascii_lowercase
-        src_files = random.sample(universe, random.randint(1, len(universe) - 1))
-        unused = set(universe) - set(src_files)
-        dst_files = src_files[1:] + [random.choice(list(unused))]
-        result_content = sorted(zip(dst_files, src_files))
-        self.put_files(*src_files)
-        self.dir_edit(self.tmpdir, '-i', self.tmpfile(*src_files), '-o', self.tmpfile(*dst_files))
-        self.assertEqual(result_content, self.list_tmpdir_content())
+        with self.seeded_random() as rng:
+            universe = string.ascii_lowercase
+            src_files = rng.sample(universe, rng.randint(1, len(universe) - 1))
+            unused = set(universe) - set(src_files)
+            dst_files = src_files[1:] + [rng.choice(list(unused))]
+            result_content = sorted(zip(dst_files, src_files))
+            self.put_files(*src_files)
+            self.dir_edit(self.tmpdir, '-i', self.tmpfile(*src_files),
+                          '-o', self.tmpfile(*dst_files))
+            self.assertEqual(result_content, self.list_tmpdir_content())
 
     def test_remove(self):
         """Test file and directory removal through empty lines."""
@@ -519,13 +626,24 @@ class DirEditTestCase(unittest.TestCase):
         self.dir_edit(self.tmpdir, '-r', '-o', self.tmpfile('x/z/a', 'x/z/b'))
         self.assertEqual(['x/z/a', 'x/z/b'], self.list_tmpdir())
 
+    @unittest.skipIf(os.name == 'nt' or os.geteuid() == 0, 'permissions not enforced')
+    def test_recursive_unreadable(self):
+        """Check that unreadable directories are skipped in recursive mode."""
+        self.put_files('a', 'x/b')
+        unreadable = os.path.join(self.tmpdir, 'x')
+        os.chmod(unreadable, 0)
+        try:
+            self.dir_edit(self.tmpdir, '-r', '-o', self.tmpfile('c'))
+        finally:
+            os.chmod(unreadable, 0o755)
+        self.assertEqual(['c', 'x/b'], self.list_tmpdir())
+
     def test_recursive_remove(self):
         """Test that recursive remove works."""
         self.put_files('a/b', 'x/y/z1', 'x/y/z2')
         self.put_dirs('z/z/z')
-        self.setup_stdout()
-        self.dir_edit(self.tmpdir, '-o', self.tmpfile('', 'x', ''))
-        self.restore_stdout()
+        with self.capture_output():
+            self.dir_edit(self.tmpdir, '-o', self.tmpfile('', 'x', ''))
         self.assertRegex(self.error, 'not removing directory a: not empty')
         self.assertEqual(['a/b', 'x/y/z1', 'x/y/z2', 'z/z/z/'], self.list_tmpdir())
         self.dir_edit(self.tmpdir, '-R', '-o', self.tmpfile('', 'x', ''))
@@ -566,6 +684,17 @@ class DirEditTestCase(unittest.TestCase):
             self.dir_edit(self.tmpdir, '-i', self.tmpfile('a'), '-o', self.tmpfile('x/y'))
         self.assertEqual(['a', 'x'], self.list_tmpdir())
 
+    def test_remove_vanished(self):
+        """Check that a path removed while editing is reported as error."""
+        self.put_files('a')
+        # Editor removes 'a' behind our back, then blanks its line:
+        editor = python_command('-c', (
+            'import os, sys; os.remove(sys.argv[1]); '
+            "open(sys.argv[2], 'w').write('\\n')"), os.path.join(self.tmpdir, 'a'))
+        with self.assertRaisesRegex(dir_edit.Error, errno_regex(errno.ENOENT)):
+            self.dir_edit(self.tmpdir, '-e', editor)
+        self.assertEqual([], self.list_tmpdir())
+
     def test_numeric_sort(self):
         """Check that '-n' and '--numeric-sort' options work."""
         self.put_files('1', '5', '10', '20')
@@ -574,12 +703,42 @@ class DirEditTestCase(unittest.TestCase):
         self.assertEqual([('a', '1'), ('b', '5'), ('c', '10'), ('d', '20')],
                          self.list_tmpdir_content())
 
+    def test_recursive_sort(self):
+        """Check that recursive mode sorts paths element by element."""
+        self.put_files('b', 'a/y', 'a-x', 'a/x/1')
+        self.put_dirs('a/e')
+        self.dir_edit(self.tmpdir, '-r', '-o', self.tmpfile('1', '2', '3', '4', '5'))
+        self.assertEqual([('1/', '<dir>'), ('2', 'a/x/1'), ('3', 'a/y'), ('4', 'a-x'), ('5', 'b')],
+                         self.list_tmpdir_content())
+        self.put_files('x/10', 'x/9', 'x/-1')
+        self.dir_edit(os.path.join(self.tmpdir, 'x'), '-r', '-n', '-o', self.tmpfile('a', 'b', 'c'))
+        self.assertEqual([('x/a', 'x/-1'), ('x/b', 'x/9'), ('x/c', 'x/10')],
+                         self.list_tmpdir_content()[5:])
+        # Equal numeric keys, ordered by name:
+        self.put_files('y/1.0', 'y/1', 'y/01', 'y/001/z')
+        self.dir_edit(os.path.join(self.tmpdir, 'y'), '-r', '-n',
+                      '-o', self.tmpfile('a', 'b', 'c', 'd'))
+        self.assertEqual([('y/a', 'y/001/z'), ('y/b', 'y/01'), ('y/c', 'y/1'), ('y/d', 'y/1.0')],
+                         self.list_tmpdir_content()[8:])
+
+    def test_collation_function(self):
+        """Check that locale.strxfrm() is skipped in the C locale only."""
+        original = locale.setlocale(locale.LC_COLLATE)
+        try:
+            locale.setlocale(locale.LC_COLLATE, 'C')
+            self.assertIs(str, dir_edit.collation_function())
+        finally:
+            locale.setlocale(locale.LC_COLLATE, original)
+        # Other locales need not be installed, only pretend to use one:
+        with mock.patch.object(locale, 'setlocale', return_value='en_US.UTF-8'):
+            self.assertIs(locale.strxfrm, dir_edit.collation_function())
+
     def test_dest_exists_recursive(self):
         """Check that existing destination error is handled in recursive mode."""
         self.put_files('a/x', 'b/y')
-        self.setup_stdout()
-        self.dir_edit(self.tmpdir, os.path.join(self.tmpdir, 'a'), '-r', '-o', self.tmpfile('b/y'))
-        self.restore_stdout()
+        with self.capture_output():
+            self.dir_edit(self.tmpdir, os.path.join(self.tmpdir, 'a'), '-r',
+                          '-o', self.tmpfile('b/y'))
         self.assertEqual([('a/x', 'a/x'), ('b/y', 'b/y')], self.list_tmpdir_content())
         regex = '(path b{}y already exists, skip|)'.format(re.escape(os.sep))
         self.assertRegex(self.error, regex)
@@ -587,16 +746,15 @@ class DirEditTestCase(unittest.TestCase):
     def test_dest_exists(self):
         """Check that existing destination error is handled."""
         self.put_files('a', 'b')
-        self.setup_stdout()
-        self.dir_edit(self.tmpdir, '-i', self.tmpfile('a'), '-o', self.tmpfile('b'))
-        self.restore_stdout()
+        with self.capture_output():
+            self.dir_edit(self.tmpdir, '-i', self.tmpfile('a'), '-o', self.tmpfile('b'))
         self.assertEqual([('a', 'a'), ('b', 'b')], self.list_tmpdir_content())
         self.assertRegex(self.error, '(path b already exists, skip|)')
 
     def test_reldir(self):
         """Check that a relative directory works."""
-        shutil.rmtree(self.tmpdir)
         self.tmpdir = tempfile.mkdtemp(dir=os.curdir)
+        self.addCleanup(shutil.rmtree, os.path.abspath(self.tmpdir))
         self.put_files('a')
         self.dir_edit(self.tmpdir, '-o', self.tmpfile('b'))
         self.assertEqual(['b'], self.list_tmpdir())
@@ -654,20 +812,20 @@ class DirEditTestCase(unittest.TestCase):
 class DirEditDryRunVerboseTestCase(DirEditTestCase):
     """Test dir_edit.py -d -v."""
     def call_dir_edit(self, args):
-        self.setup_stdout()
-        try:
+        with self.capture_output():
             dir_edit.main_throws(['--dry-run', '--verbose'] + args)
-        finally:
-            self.restore_stdout()
         try:
-            subprocess.check_output(self.output, shell=True, universal_newlines=True,
+            # One shell for all commands, stopping at the first failure like 'sh -e log.txt':
+            subprocess.check_output(['sh', '-e', '-c', self.output], universal_newlines=True,
                                     stderr=subprocess.STDOUT)
         except subprocess.CalledProcessError as exc:
             raise dir_edit.Error(exc.output)
 
+    @unittest.skip('already uses --dry-run')
     def test_dry_run(self):
         """Not necessary here."""
 
+    @unittest.skip('already uses --verbose')
     def test_verbose_logfile(self):
         """Not necessary here."""
 